@@ -0,0 +1,275 @@
+"""Opt-in diagnostics for the server: per-request profiling and a slow-query log.
+
+Both are off by default and cost nothing when off: the profiling middleware
+returns straight to the app unless a profile token is configured, and the
+slow-query wrappers are only used as the sqlite3 connection factory when a
+threshold is set (see get_conn() in main.py).
+"""
+from __future__ import annotations
+import asyncio
+import contextvars
+import cProfile
+import hmac
+import logging
+import pstats
+import re
+import sqlite3
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, UTC
+from pathlib import Path
+from typing import Optional
+
+slow_query_log = logging.getLogger("trainfriends.slow_query")
+
+PROFILE_HEADER = b"x-profile-token"
+_PLANNED_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+# profilers of the worker-thread calls made by the request being profiled, if any
+_thread_profiles: contextvars.ContextVar[Optional[list]] = contextvars.ContextVar(
+    "thread_profiles", default=None
+)
+
+
+@dataclass
+class ProfilingConfig:
+    # profiling is enabled only when token is set; requests opt in by sending
+    # it in the X-Profile-Token header
+    token: Optional[str] = None
+    directory: Path = Path(__file__).resolve().parent / "profiles"
+    # a profile is closed after this many seconds even if the response is still
+    # streaming, so one long request cannot block profiling of all others
+    max_seconds: float = 30.0
+    # metadata of stored profiles, oldest first; its maxlen caps the files kept on disk
+    recent: deque = field(default_factory=lambda: deque(maxlen=50))
+
+    def authorized(self, supplied: Optional[str | bytes]) -> bool:
+        if self.token is None or not supplied:
+            return False
+        if isinstance(supplied, str):
+            supplied = supplied.encode()
+        return hmac.compare_digest(supplied, self.token.encode())
+
+    def profile_path(self, profile_id: str) -> Path:
+        return self.directory / f"{profile_id}.prof"
+
+    def load_stored(self) -> None:
+        """Seed `recent` with the profiles earlier runs left in directory.
+
+        The oldest files beyond the maxlen of `recent` are deleted, so the cap on
+        stored profiles holds across restarts. Only id and file time are known
+        for these entries.
+        """
+        if not self.directory.is_dir():
+            return
+        stored = sorted(
+            (p.stat().st_mtime, p)
+            for p in self.directory.glob("*.prof")
+            if re.fullmatch(r"[0-9a-f]{32}", p.stem)
+        )
+        keep = stored[-self.recent.maxlen :] if self.recent.maxlen else []
+        for _, p in stored[: len(stored) - len(keep)]:
+            p.unlink(missing_ok=True)
+        for mtime, p in keep:
+            self.recent.append(
+                {
+                    "id": p.stem,
+                    "method": None,
+                    "path": None,
+                    "durationMs": None,
+                    "ts": datetime.fromtimestamp(mtime, UTC).isoformat(),
+                }
+            )
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that runs cProfile around requests carrying the profile token.
+
+    The profile is written to `<directory>/<id>.prof` (pstats format) and the id
+    is returned in the X-Profile-Id response header. cProfile is per-thread, so
+    other coroutines scheduled while the request awaits show up in the profile as
+    well, and only one request is profiled at a time. Work the request hands to
+    worker threads is only included when it goes through to_thread() below. SSE
+    requests are never profiled, and any profile is cut off after `max_seconds`.
+    """
+
+    def __init__(self, app, config: ProfilingConfig):
+        self.app = app
+        self.config = config
+        self._busy = False
+
+    async def __call__(self, scope, receive, send):
+        if self.config.token is None or scope["type"] != "http" or self._busy:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        if not self.config.authorized(headers.get(PROFILE_HEADER)) or b"text/event-stream" in headers.get(
+            b"accept", b""
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = cProfile.Profile()
+        thread_profiles: list[cProfile.Profile] = []
+        start = time.perf_counter()
+        finished = False
+
+        def finish():
+            # runs on the event loop thread, the same thread the profiler is enabled on
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            profiler.disable()
+            self._busy = False
+            # worker calls still running are left out
+            self._store(profiler, list(thread_profiles), profile_id, scope, time.perf_counter() - start)
+
+        self._busy = True
+        cutoff = asyncio.get_running_loop().call_later(self.config.max_seconds, finish)
+        context_token = _thread_profiles.set(thread_profiles)
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            cutoff.cancel()
+            finish()
+            _thread_profiles.reset(context_token)
+
+    def _store(self, profiler: cProfile.Profile, thread_profiles: list, profile_id: str, scope, seconds: float) -> None:
+        cfg = self.config
+        cfg.directory.mkdir(parents=True, exist_ok=True)
+        stats = pstats.Stats(profiler)
+        for p in thread_profiles:
+            stats.add(p)
+        stats.dump_stats(str(cfg.profile_path(profile_id)))
+        if len(cfg.recent) == cfg.recent.maxlen:
+            # drop the file of the entry about to fall off the list
+            cfg.profile_path(cfg.recent[0]["id"]).unlink(missing_ok=True)
+        cfg.recent.append(
+            {
+                "id": profile_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "durationMs": round(seconds * 1000, 2),
+                "ts": datetime.now(UTC).isoformat(),
+            }
+        )
+
+
+async def to_thread(func, /, *args):
+    """asyncio.to_thread() that profiles func as well when the calling request is profiled.
+
+    The worker gets its own cProfile profiler (the middleware's only sees the
+    event loop thread) whose stats are merged into the request's profile.
+    """
+    if _thread_profiles.get() is None:
+        return await asyncio.to_thread(func, *args)
+    return await asyncio.to_thread(_run_profiled, func, *args)
+
+
+def _run_profiled(func, *args):
+    # runs in the worker thread; to_thread copies the request's context into it
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler per interpreter, and it
+        # already covers all threads
+        return func(*args)
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+        _thread_profiles.get().append(profiler)
+
+
+def _params_shape(parameters) -> str:
+    """Describe parameters by type only, so values (passwords, positions) never reach the log."""
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    types = [type(p).__name__ for p in parameters]
+    if len(types) > 3 and len(set(types)) == 1:
+        return f"({types[0]} x{len(types)})"
+    return "(" + ", ".join(types) + ")"
+
+
+def _query_plan(conn: sqlite3.Connection, sql: str, parameters) -> list[str]:
+    if not sql.lstrip().upper().startswith(_PLANNED_STATEMENTS):
+        return []
+    try:
+        # plain cursor so the EXPLAIN itself is not timed and logged
+        cur = sqlite3.Connection.cursor(conn, sqlite3.Cursor)
+        return [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}", parameters)]
+    except sqlite3.Error as e:
+        return [f"unavailable: {e}"]
+
+
+class SlowQueryCursor(sqlite3.Cursor):
+    """Cursor that logs statements whose execute + fetch time exceeds the connection threshold."""
+
+    _stmt: Optional[list] = None
+
+    def execute(self, sql, parameters=()):
+        # [sql, parameters, elapsed seconds, already logged]
+        self._stmt = [sql, parameters, 0.0, False]
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._observe(time.perf_counter() - start)
+
+    def _observe(self, elapsed: float) -> None:
+        stmt = self._stmt
+        if stmt is None:
+            return
+        stmt[2] += elapsed
+        if stmt[3] or stmt[2] * 1000 < self.connection.slow_query_ms:
+            return
+        stmt[3] = True
+        sql, parameters = stmt[0], stmt[1]
+        slow_query_log.warning(
+            "slow query %.1f ms: %s params=%s plan=%s",
+            stmt[2] * 1000,
+            " ".join(sql.split()),
+            _params_shape(parameters),
+            _query_plan(self.connection, sql, parameters),
+        )
+
+
+class SlowQueryConnection(sqlite3.Connection):
+    """sqlite3 connection factory whose cursors feed the slow-query log."""
+
+    slow_query_ms: float = 100.0
+
+    def cursor(self, factory=SlowQueryCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        # sqlite3.Connection.execute bypasses cursor(), so route it explicitly
+        return self.cursor().execute(sql, parameters)
@@ -5,6 +5,8 @@ Usage:
   python server/dump_db.py [--data PATH] [--json]
 
 Default DB path is the `data.db` file next to this script (same as server/main.py uses).
+Shard files written by `main.py --shards N` (`data.shard<i>.db` next to the DB) are
+read as well, and rows of tables present in several files are concatenated.
 """
 from __future__ import annotations
 import argparse
@@ -21,6 +23,17 @@ def get_default_db() -> Path:
     return Path(__file__).resolve().parent / "data.db"
 
 
+def get_shard_files(db_path: Path) -> list[Path]:
+    """Return the shard files belonging to db_path, ordered by shard index."""
+    shards = db_path.parent.glob(f"{db_path.stem}.shard*{db_path.suffix}")
+    indexed = []
+    for pth in shards:
+        index = pth.name[len(db_path.stem) + len(".shard") : len(pth.name) - len(db_path.suffix)]
+        if index.isdigit():
+            indexed.append((int(index), pth))
+    return [pth for _, pth in sorted(indexed)]
+
+
 def main() -> None:
     p = argparse.ArgumentParser(description="Dump all tables from TrainFriends sqlite DB")
     p.add_argument("--data", help="Path to sqlite data file (overrides default)")
@@ -51,8 +64,10 @@ def main() -> None:
         if not args.yes:
             print("Refusing to delete DB. Rerun with --yes to confirm.")
             sys.exit(3)
-        # attempt to remove main db and possible -shm and -wal files
-        to_remove = [db_path, db_path.with_suffix(db_path.suffix + "-shm"), db_path.with_suffix(db_path.suffix + "-wal")]
+        # attempt to remove main db, its shards and possible -shm and -wal files
+        to_remove = []
+        for base in [db_path, *get_shard_files(db_path)]:
+            to_remove += [base, base.with_suffix(base.suffix + "-shm"), base.with_suffix(base.suffix + "-wal")]
         removed = []
         for pth in to_remove:
             try:
@@ -65,23 +80,25 @@ def main() -> None:
         return
 
     def read_db(path: Path):
-        """Return (tables, out) reading the sqlite DB at path."""
+        """Return (tables, out) reading the sqlite DB at path and its shard files."""
         if not path.exists():
             return [], {}
-        conn = sqlite3.connect(str(path))
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
-        tables = [r[0] for r in cur.fetchall()]
         out = {}
-        for t in tables:
-            try:
-                rows = conn.execute(f"SELECT * FROM {t}").fetchall()
-                out[t] = [dict(r) for r in rows]
-            except Exception as e:
-                out[t] = {"error": str(e)}
-        conn.close()
-        return tables, out
+        for pth in [path, *get_shard_files(path)]:
+            conn = sqlite3.connect(str(pth))
+            conn.row_factory = sqlite3.Row
+            cur = conn.cursor()
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name")
+            for t in [r[0] for r in cur.fetchall()]:
+                if isinstance(out.get(t), dict):
+                    continue
+                try:
+                    rows = conn.execute(f"SELECT * FROM {t}").fetchall()
+                    out.setdefault(t, []).extend(dict(r) for r in rows)
+                except Exception as e:
+                    out[t] = {"error": f"{pth.name}: {e}"}
+            conn.close()
+        return sorted(out), out
 
     def render(tables, out, to_json: bool, csv_arg):
         # JSON
@@ -159,7 +176,7 @@ def main() -> None:
                 time.sleep(interval)
                 continue
 
-            mtime = db_path.stat().st_mtime
+            mtime = max(pth.stat().st_mtime for pth in [db_path, *get_shard_files(db_path)])
             if last_mtime is None or mtime != last_mtime:
                 # changed -> re-read and print
                 last_mtime = mtime
@@ -0,0 +1,162 @@
+"""In-memory materialized friend feeds (fan-out-on-write for /location).
+
+Every user with recent activity has one trail: a deque of their latest location
+entries, oldest first. A user's feed maps each friend to that friend's trail
+object, so a post is a single append that is immediately visible in every
+friend's feed, and reading a feed needs no friend or location query.
+
+The class is purely in-memory. Feeds and trails are filled lazily by the caller
+from the database (the DB stays the source of truth, so a restart only costs
+one load per active user): begin_load / finish_load bracket a trail load that
+runs off the event loop, buffering posts that arrive meanwhile, and set_feed
+installs a feed once its trails are loaded. add_friendship / remove_friendship
+keep materialized feeds in sync. Trails hold everything newer than the cutoff
+passed by the caller, so a feed returns the same entries as the SQL query it
+replaces. Feeds not read for `idle_seconds` are dropped, together with the
+trails no remaining feed uses. All methods are synchronous and must be called
+from the event loop thread.
+"""
+from __future__ import annotations
+import heapq
+import time
+from collections import deque
+from typing import Optional
+
+
+class FriendFeeds:
+    def __init__(self, idle_seconds: float = 15 * 60):
+        self.idle_seconds = idle_seconds
+        self.trails: dict[str, deque] = {}
+        self.feeds: dict[str, dict[str, deque]] = {}
+        self.last_read: dict[str, float] = {}
+        # per user, one buffer of posts for each trail load in flight
+        self.loading: dict[str, list[list[dict]]] = {}
+        # bumped on every friendship change, see set_feed
+        self.version = 0
+        self._last_sweep = time.monotonic()
+
+    def has_feed(self, user: str) -> bool:
+        return user in self.feeds
+
+    def unloaded(self, users: list[str]) -> list[str]:
+        return [u for u in users if u not in self.trails]
+
+    def begin_load(self, users: list[str]) -> dict[str, list[dict]]:
+        """Start buffering posts of users whose trails are about to be read from the DB."""
+        buffers = {}
+        for user in users:
+            buffers[user] = []
+            self.loading.setdefault(user, []).append(buffers[user])
+        return buffers
+
+    def finish_load(self, buffers: dict[str, list[dict]], loaded: Optional[dict[str, list[dict]]]) -> None:
+        """Install the trails read from the DB (oldest first) merged with the buffered posts.
+
+        loaded is None when the load failed; the buffers are just released then.
+        Trails loaded by a concurrent load in the meantime are kept as they are.
+        """
+        for user, buffer in buffers.items():
+            pending = self.loading[user]
+            pending.remove(buffer)
+            if not pending:
+                del self.loading[user]
+            if loaded is None or user in self.trails:
+                continue
+            trail = self.trails[user] = deque(loaded.get(user, ()))
+            for entry in buffer:
+                self._insert(trail, entry)
+
+    def set_feed(self, user: str, friends: list[str], version: int) -> None:
+        """Materialize user's feed from the already loaded trails of friends.
+
+        version is the value of self.version from before friends was read from
+        the DB; if a friendship changed since then, or a trail has been swept in
+        the meantime, nothing is installed and the caller has to load again.
+        """
+        if user in self.feeds or version != self.version or self.unloaded(friends):
+            return
+        self.feeds[user] = {f: self.trails[f] for f in friends}
+        self.last_read[user] = time.monotonic()
+
+    @staticmethod
+    def _prune(trail: deque, cutoff: str) -> None:
+        while trail and trail[0]["ts"] < cutoff:
+            trail.popleft()
+
+    @staticmethod
+    def _insert(trail: deque, entry: dict) -> None:
+        if trail and trail[-1]["ts"] >= entry["ts"]:
+            # the row is written off the event loop, so the trail may have been
+            # loaded with it already, or a later post may have landed first
+            if any(e["ts"] == entry["ts"] for e in trail):
+                return
+            ordered = sorted([*trail, entry], key=lambda e: e["ts"])
+            trail.clear()
+            trail.extend(ordered)
+        else:
+            trail.append(entry)
+
+    def post(self, user: str, entry: dict, cutoff: str) -> None:
+        """Append an entry that has already been stored in the DB to user's trail.
+
+        A trail that is not loaded yet is left alone: the next load reads the
+        entry from the DB. Loads in flight get the entry through their buffer.
+        """
+        for buffer in self.loading.get(user, ()):
+            buffer.append(entry)
+        trail = self.trails.get(user)
+        if trail is None:
+            return
+        self._insert(trail, entry)
+        self._prune(trail, cutoff)
+
+    def read(self, user: str, cutoff: str) -> list[dict]:
+        """Return all friends' entries newer than cutoff, ordered by ts.
+
+        The feed must have been installed with set_feed.
+        """
+        now = time.monotonic()
+        self.last_read[user] = now
+        if now - self._last_sweep >= self.idle_seconds:
+            self._sweep(now)
+        feed = self.feeds[user]
+        for trail in feed.values():
+            self._prune(trail, cutoff)
+        return list(heapq.merge(*feed.values(), key=lambda e: e["ts"]))
+
+    def _sweep(self, now: float) -> None:
+        """Drop idle feeds and every trail that no remaining feed references.
+
+        Trails still referenced are kept even when empty, since posts must keep
+        landing in them.
+        """
+        self._last_sweep = now
+        for user, seen in list(self.last_read.items()):
+            if now - seen >= self.idle_seconds:
+                del self.last_read[user]
+                self.feeds.pop(user, None)
+        referenced = {friend for feed in self.feeds.values() for friend in feed}
+        for user in list(self.trails):
+            if user not in referenced:
+                del self.trails[user]
+
+    def add_friendship(self, a: str, b: str) -> None:
+        # feeds that are not materialized yet pick the friend up when first
+        # built; a materialized feed whose new friend's trail is not loaded is
+        # dropped and rebuilt on its next read
+        self.version += 1
+        for user, friend in ((a, b), (b, a)):
+            feed = self.feeds.get(user)
+            if feed is None:
+                continue
+            if friend in self.trails:
+                feed[friend] = self.trails[friend]
+            else:
+                del self.feeds[user]
+
+    def remove_friendship(self, a: str, b: str) -> None:
+        self.version += 1
+        for user, friend in ((a, b), (b, a)):
+            feed = self.feeds.get(user)
+            if feed is not None:
+                feed.pop(friend, None)
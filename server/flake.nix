@@ -29,6 +29,7 @@
                 ps: with ps; [
                   fastapi
                   uvicorn
+                  websockets
                   firebase-admin
                 ]
               ))
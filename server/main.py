@@ -1,9 +1,21 @@
 from fastapi import FastAPI, Request, Response, Depends, HTTPException, status
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse, PlainTextResponse
 from pydantic import BaseModel
 import uuid
+from contextlib import asynccontextmanager
 import asyncio
+import io
+import hmac
 import json
+import logging
+import math
+import pstats
+import re
+import time
+import threading
+import heapq
+import zlib
 from typing import Set, Optional
 from datetime import datetime, timedelta, UTC
 import sqlite3
@@ -12,17 +24,33 @@ from firebase_admin import credentials
 from pathlib import Path
 from starlette.middleware import Middleware
 from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import HTTPConnection
+import stations
+import diagnostics
+import feed
+import passwords
 
 cred = credentials.Certificate("firebase.json")
 firebase_admin.initialize_app(cred)
 
 
+# Browser origins allowed to call the API; also enforced on /ws handshakes,
+# which CORS does not cover
+ALLOWED_ORIGINS = ["http://localhost:5173"]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    password_hasher.close()
+
+
 app = FastAPI(
     title="TrainFriends - Simple Server",
+    lifespan=lifespan,
     middleware=[
         Middleware(
             CORSMiddleware,
-            allow_origins=["http://localhost:5173"],
+            allow_origins=ALLOWED_ORIGINS,
             allow_credentials=True,
             allow_methods=["*"],
             allow_headers=["*"],
@@ -30,14 +58,54 @@ app = FastAPI(
     ],
 )
 
+# Per-request profiling (off unless --profile-token is given) and slow-query
+# threshold in ms for statements run through get_conn() (None disables logging)
+profiling = diagnostics.ProfilingConfig()
+app.add_middleware(diagnostics.ProfilingMiddleware, config=profiling)
+SLOW_QUERY_MS: Optional[float] = None
+
 # Simple SQLite DB (file stored next to this module)
 # Default path (can be overridden with --data flag when running as a script)
 DB_PATH = Path(__file__).resolve().parent / "data.db"
 db_initialized = False
 
-# SSE per-user queues for pushing events (in-memory)
+# Number of SQLite files the per-user tables (locations, sessions) are
+# hash-partitioned across (set with --shards). 1 keeps everything in DB_PATH;
+# otherwise shard i lives next to it as `<stem>.shard<i><suffix>` while users,
+# friends and friend_requests stay in DB_PATH.
+SHARDS = 1
+# Seconds a connection waits for another writer's lock before failing. Session
+# and location statements run in worker threads (diagnostics.to_thread), so writers
+# to the same file do contend.
+SQLITE_TIMEOUT = 5.0
+_init_lock = threading.Lock()
+
+# Optional GTFS feed directory (set with --gtfs) used to annotate locations
+# with the nearest station and line; None disables the lookup.
+GTFS_PATH: Optional[Path] = None
+station_index: Optional[stations.StationIndex] = None
+
+# How /location gathers friends' positions: "read" queries friends and locations
+# on every call (fan-out-on-read), "write" serves them from the in-memory
+# materialized feeds in `friend_feeds` (fan-out-on-write)
+FRIEND_FEED = "read"
+
+# Password hashing runs on a process pool of this many workers; further logins
+# queue up to max_waiting and are then answered with 503 (see --hash-workers)
+password_hasher = passwords.PasswordHasher(workers=2, max_waiting=64)
+# /admin/metrics is served only to requests sending this in X-Metrics-Token
+# (set with --metrics-token); None disables the endpoint
+METRICS_TOKEN: Optional[str] = None
+
+# SSE / WebSocket per-user queues for pushing events (in-memory); each holds
+# JSON-encoded events, see publish()
 sse_queues: dict[str, Set[asyncio.Queue]] = {}
 
+# /ws: seconds between server pings, and the minimum spacing of stored location
+# frames per connection (faster frames are dropped)
+WS_PING_INTERVAL = 15.0
+WS_MIN_LOCATION_INTERVAL = 1.0
+
 
 class SignupRequest(BaseModel):
     username: str
@@ -67,16 +135,94 @@ class Location(BaseModel):
 # LocationWithFriends removed: /location will determine friends from DB
 
 
-def get_conn():
-    # Ensure DB is initialized for the chosen DB_PATH before opening connections
-    global db_initialized
-    if not db_initialized:
-        init_db()
-    conn = sqlite3.connect(str(DB_PATH))
+def _connect(path: Path):
+    if SLOW_QUERY_MS is None:
+        conn = sqlite3.connect(str(path), timeout=SQLITE_TIMEOUT)
+    else:
+        conn = sqlite3.connect(
+            str(path), timeout=SQLITE_TIMEOUT, factory=diagnostics.SlowQueryConnection
+        )
+        conn.slow_query_ms = SLOW_QUERY_MS
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def ensure_db():
+    # Ensure DB is initialized for the chosen DB_PATH before opening connections;
+    # connections are opened from worker threads too, hence the lock
+    if not db_initialized:
+        with _init_lock:
+            if not db_initialized:
+                init_db()
+
+
+def get_conn():
+    ensure_db()
+    return _connect(DB_PATH)
+
+
+def shard_path(index: int) -> Path:
+    return DB_PATH.with_name(f"{DB_PATH.stem}.shard{index}{DB_PATH.suffix}")
+
+
+def shard_of(key: str) -> int:
+    # crc32 rather than hash(): str hashes are salted per process
+    return zlib.crc32(key.encode()) % SHARDS
+
+
+def get_shard_conn(index: int):
+    """Open the DB holding shard `index` of the per-user tables.
+
+    Rows are routed with shard_of(): locations by username, sessions by
+    session_id (the only key a session is looked up by).
+    """
+    if SHARDS == 1:
+        return get_conn()
+    ensure_db()
+    return _connect(shard_path(index))
+
+
+# per-user tables, created in DB_PATH and in every shard file
+SHARDED_TABLES = [
+    """
+		CREATE TABLE IF NOT EXISTS locations (
+			username TEXT NOT NULL,
+			latitude REAL NOT NULL,
+			longitude REAL NOT NULL,
+			ts TEXT NOT NULL,
+			station TEXT,
+			station_distance REAL,
+			line TEXT,
+			line_distance REAL
+		)
+		""",
+    """
+		CREATE TABLE IF NOT EXISTS sessions (
+			session_id TEXT PRIMARY KEY,
+			username TEXT NOT NULL
+		)
+		""",
+]
+
+
+# nearest GTFS stop / line stored with each location row (added after the
+# table was first released, so older files get them through upgrade_locations)
+LOCATION_TRANSIT_COLUMNS = [
+    ("station", "TEXT"),
+    ("station_distance", "REAL"),
+    ("line", "TEXT"),
+    ("line_distance", "REAL"),
+]
+LOCATION_COLUMNS = "username, latitude, longitude, ts, station, station_distance, line, line_distance"
+
+
+def upgrade_locations(conn: sqlite3.Connection) -> None:
+    existing = {r[1] for r in conn.execute("PRAGMA table_info(locations)").fetchall()}
+    for name, sql_type in LOCATION_TRANSIT_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE locations ADD COLUMN {name} {sql_type}")
+
+
 def init_db():
     """Create DB file and tables for the current DB_PATH. Safe to call multiple times.
 
@@ -97,25 +243,11 @@ def init_db():
 		)
 		"""
     )
-    # new table to store multiple location entries per user; entries are pruned after 15 minutes
-    cur.execute(
-        """
-		CREATE TABLE IF NOT EXISTS locations (
-			username TEXT NOT NULL,
-			latitude REAL NOT NULL,
-			longitude REAL NOT NULL,
-			ts TEXT NOT NULL
-		)
-		"""
-    )
-    cur.execute(
-        """
-		CREATE TABLE IF NOT EXISTS sessions (
-			session_id TEXT PRIMARY KEY,
-			username TEXT NOT NULL
-		)
-		"""
-    )
+    # locations: multiple entries per user, pruned after 15 minutes; sessions.
+    # With SHARDS > 1 these tables stay empty here and the rows live in the shards.
+    for ddl in SHARDED_TABLES:
+        cur.execute(ddl)
+    upgrade_locations(conn)
     cur.execute(
         """
 		CREATE TABLE IF NOT EXISTS friend_requests (
@@ -136,15 +268,290 @@ def init_db():
 		)
 		"""
     )
+    cur.execute(
+        """
+		CREATE TABLE IF NOT EXISTS meta (
+			key TEXT PRIMARY KEY,
+			value TEXT NOT NULL
+		)
+		"""
+    )
 
     conn.commit()
+    init_shards(conn)
     conn.close()
     db_initialized = True
 
 
+def init_shards(conn: sqlite3.Connection) -> None:
+    """Create the shard files and move per-user rows out of DB_PATH into them.
+
+    Moving is a no-op once DB_PATH's per-user tables are empty, so this doubles
+    as the migration of an existing single-file DB. Each shard is filled and its
+    rows deleted from DB_PATH in one transaction, after which the shard is
+    switched to WAL so its readers do not block its writer. Changing the shard
+    count of an already sharded DB is not supported.
+    """
+    row = conn.execute("SELECT value FROM meta WHERE key = 'shards'").fetchone()
+    if row and int(row["value"]) != SHARDS:
+        raise RuntimeError(
+            f"{DB_PATH} is split into {row['value']} shards; start the server with --shards {row['value']}"
+        )
+    if SHARDS == 1:
+        return
+
+    conn.create_function("shard_of", 1, shard_of, deterministic=True)
+    for index in range(SHARDS):
+        path = shard_path(index)
+        shard = sqlite3.connect(str(path))
+        for ddl in SHARDED_TABLES:
+            shard.execute(ddl)
+        upgrade_locations(shard)
+        shard.commit()
+        shard.close()
+
+        conn.execute("ATTACH DATABASE ? AS shard", (str(path),))
+        with conn:
+            conn.execute(
+                f"INSERT INTO shard.locations({LOCATION_COLUMNS}) SELECT {LOCATION_COLUMNS} FROM main.locations WHERE shard_of(username) = ?",
+                (index,),
+            )
+            conn.execute("DELETE FROM main.locations WHERE shard_of(username) = ?", (index,))
+            conn.execute(
+                "INSERT OR IGNORE INTO shard.sessions SELECT * FROM main.sessions WHERE shard_of(session_id) = ?",
+                (index,),
+            )
+            conn.execute("DELETE FROM main.sessions WHERE shard_of(session_id) = ?", (index,))
+        conn.execute("DETACH DATABASE shard")
+        # WAL only after the move: transactions spanning attached WAL files are
+        # not atomic across them
+        shard = sqlite3.connect(str(path))
+        shard.execute("PRAGMA journal_mode=WAL")
+        shard.close()
+    conn.execute(
+        "INSERT OR REPLACE INTO meta(key, value) VALUES ('shards', ?)", (str(SHARDS),)
+    )
+    conn.commit()
+
+
+def nearest_transit(latitude: float, longitude: float) -> dict:
+    """Return {station, line} for a point; both are None without a GTFS index."""
+    if station_index is None:
+        return {"station": None, "line": None}
+    return {
+        "station": station_index.nearest_station(latitude, longitude),
+        "line": station_index.nearest_line(latitude, longitude),
+    }
+
+
+def location_entry(
+    username: str,
+    latitude: float,
+    longitude: float,
+    ts: str,
+    station: Optional[dict],
+    line: Optional[dict],
+) -> dict:
+    return {
+        "username": username,
+        "location": {"latitude": latitude, "longitude": longitude},
+        "ts": ts,
+        "station": station,
+        "line": line,
+    }
+
+
+def row_entry(r: sqlite3.Row) -> dict:
+    """Build a location entry from a `locations` row selected with LOCATION_COLUMNS."""
+    station = line = None
+    if r["station"] is not None:
+        station = {"name": r["station"], "distance": r["station_distance"]}
+    if r["line"] is not None:
+        line = {"name": r["line"], "distance": r["line_distance"]}
+    return location_entry(r["username"], r["latitude"], r["longitude"], r["ts"], station, line)
+
+
+def load_friends(username: str) -> list[str]:
+    conn = get_conn()
+    cur = conn.execute(
+        "SELECT friend FROM friends WHERE user = ? ORDER BY friend", (username,)
+    )
+    friends = [r["friend"] for r in cur.fetchall()]
+    conn.close()
+    return friends
+
+
+def load_trails(usernames: list[str]) -> dict[str, list[dict]]:
+    """Return the stored entries of each user, oldest first (one query per shard)."""
+    by_shard: dict[int, list[str]] = {}
+    for name in usernames:
+        by_shard.setdefault(shard_of(name), []).append(name)
+    trails: dict[str, list[dict]] = {name: [] for name in usernames}
+    for index, names in by_shard.items():
+        conn = get_shard_conn(index)
+        placeholders = ",".join("?" for _ in names)
+        cur = conn.execute(
+            f"SELECT {LOCATION_COLUMNS} FROM locations WHERE username IN ({placeholders}) ORDER BY ts",
+            names,
+        )
+        for r in cur.fetchall():
+            trails[r["username"]].append(row_entry(r))
+        conn.close()
+    return trails
+
+
+friend_feeds = feed.FriendFeeds()
+
+
+async def ensure_trails(usernames: list[str]) -> None:
+    """Load the friend feed trails of usernames that are not in memory yet, off the event loop."""
+    missing = friend_feeds.unloaded(usernames)
+    if not missing:
+        return
+    buffers = friend_feeds.begin_load(missing)
+    loaded = None
+    try:
+        loaded = await diagnostics.to_thread(load_trails, missing)
+    finally:
+        friend_feeds.finish_load(buffers, loaded)
+
+
+async def ensure_feed(username: str) -> None:
+    """Materialize username's friend feed; the SQLite reads run in worker threads."""
+    while not friend_feeds.has_feed(username):
+        version = friend_feeds.version
+        friends = await diagnostics.to_thread(load_friends, username)
+        await ensure_trails(friends)
+        friend_feeds.set_feed(username, friends, version)
+
+
+def publish(usernames, event: dict) -> None:
+    """Push an event to every SSE / WebSocket connection of the given users.
+
+    Queues are bounded; when a consumer falls behind its oldest event is dropped
+    so it always receives the most recent state.
+    """
+    data = None
+    for user in usernames:
+        for q in sse_queues.get(user, ()):
+            if data is None:
+                data = json.dumps(event)
+            if q.full():
+                q.get_nowait()
+            q.put_nowait(data)
+
+
+def unsubscribe(username: str, q: asyncio.Queue) -> None:
+    queues = sse_queues.get(username)
+    if queues is not None:
+        queues.discard(q)
+        if not queues:
+            del sse_queues[username]
+
+
+def location_cutoff() -> str:
+    return (datetime.utcnow() - timedelta(minutes=15)).isoformat()
+
+
+def store_location(username: str, row: tuple, cutoff: str) -> None:
+    # only the poster's shard is pruned here; readers filter by cutoff as well
+    conn = get_shard_conn(shard_of(username))
+    conn.execute(
+        f"INSERT INTO locations({LOCATION_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", row
+    )
+    conn.execute("DELETE FROM locations WHERE ts < ?", (cutoff,))
+    conn.commit()
+    conn.close()
+
+
+async def record_location(username: str, latitude: float, longitude: float) -> None:
+    """Store a location entry, prune entries older than 15 minutes and notify friends.
+
+    The SQLite write runs in a worker thread, so posts to different shards
+    proceed in parallel and none of them blocks the event loop.
+    """
+    ts = datetime.now(UTC).isoformat()
+    cutoff = location_cutoff()
+    # the GTFS lookup runs once here and is stored with the row, not per read
+    transit = nearest_transit(latitude, longitude)
+    station, line = transit["station"], transit["line"]
+    row = (
+        username,
+        latitude,
+        longitude,
+        ts,
+        station and station["name"],
+        station and station["distance"],
+        line and line["name"],
+        line and line["distance"],
+    )
+    await diagnostics.to_thread(store_location, username, row, cutoff)
+
+    entry = location_entry(username, latitude, longitude, ts, station, line)
+    friend_feeds.post(username, entry, cutoff)
+    if sse_queues:
+        # friendship is symmetric, so a materialized feed also lists who to notify
+        feed_of_user = friend_feeds.feeds.get(username)
+        if feed_of_user is not None:
+            friends = list(feed_of_user)
+        else:
+            friends = await diagnostics.to_thread(load_friends, username)
+        publish(
+            friends,
+            {
+                "type": "location",
+                "from": username,
+                "latitude": latitude,
+                "longitude": longitude,
+                "ts": ts,
+                "station": station,
+                "line": line,
+            },
+        )
+
+
+def query_locations(index: int, names: list[str], cutoff: str) -> list[dict]:
+    conn = get_shard_conn(index)
+    placeholders = ",".join("?" for _ in names)
+    cur = conn.execute(
+        f"SELECT {LOCATION_COLUMNS} FROM locations WHERE username IN ({placeholders}) AND ts >= ? ORDER BY ts",
+        (*names, cutoff),
+    )
+    rows = [row_entry(r) for r in cur.fetchall()]
+    conn.close()
+    return rows
+
+
+async def friend_locations(username: str, cutoff: str) -> list[dict]:
+    """Return all location entries newer than cutoff for username's friends, ordered by ts."""
+    if FRIEND_FEED == "write":
+        # in-memory; only a feed's first read loads from SQLite
+        await ensure_feed(username)
+        return friend_feeds.read(username, cutoff)
+
+    # determine friends from the friends table for the current user
+    friends = await diagnostics.to_thread(load_friends, username)
+    if not friends:
+        return []
+
+    by_shard: dict[int, list[str]] = {}
+    for friend in friends:
+        by_shard.setdefault(shard_of(friend), []).append(friend)
+
+    # query locations for the friends, one query per shard holding any of them,
+    # run concurrently in worker threads
+    per_shard = await asyncio.gather(
+        *(
+            diagnostics.to_thread(query_locations, index, names, cutoff)
+            for index, names in by_shard.items()
+        )
+    )
+    return list(heapq.merge(*per_shard, key=lambda e: e["ts"]))
+
+
 def create_session(username: str) -> str:
     sid = uuid.uuid4().hex
-    conn = get_conn()
+    conn = get_shard_conn(shard_of(sid))
     conn.execute(
         "INSERT INTO sessions(session_id, username) VALUES (?, ?)", (sid, username)
     )
@@ -153,11 +560,18 @@ def create_session(username: str) -> str:
     return sid
 
 
-def get_username_from_cookie(request: Request) -> Optional[str]:
+def delete_session(sid: str) -> None:
+    conn = get_shard_conn(shard_of(sid))
+    conn.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
+    conn.commit()
+    conn.close()
+
+
+def get_username_from_cookie(request: HTTPConnection) -> Optional[str]:
     sid = request.cookies.get("session_id")
     if not sid:
         return None
-    conn = get_conn()
+    conn = get_shard_conn(shard_of(sid))
     cur = conn.execute("SELECT username FROM sessions WHERE session_id = ?", (sid,))
     row = cur.fetchone()
     conn.close()
@@ -165,7 +579,7 @@ def get_username_from_cookie(request: Request) -> Optional[str]:
 
 
 async def get_current_username(request: Request) -> str:
-    username = get_username_from_cookie(request)
+    username = await diagnostics.to_thread(get_username_from_cookie, request)
     if not username:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized"
@@ -173,20 +587,51 @@ async def get_current_username(request: Request) -> str:
     return username
 
 
+async def run_hasher(awaitable):
+    """Await a password_hasher call, turning load shedding into a 503."""
+    try:
+        return await awaitable
+    except passwords.PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server busy, try again")
+
+
+async def require_metrics_token(request: Request) -> None:
+    if METRICS_TOKEN is None:
+        raise HTTPException(status_code=404, detail="Metrics disabled")
+    supplied = request.headers.get("x-metrics-token", "")
+    if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+
+async def require_profile_token(request: Request) -> None:
+    if profiling.token is None:
+        raise HTTPException(status_code=404, detail="Profiling disabled")
+    if not profiling.authorized(request.headers.get("x-profile-token")):
+        raise HTTPException(status_code=403, detail="Not allowed")
+
+
 @app.post("/signup", response_model=GenericResponse)
 async def signup(req: SignupRequest):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT 1 FROM users WHERE username = ?", (req.username,))
-    if cur.fetchone():
-        conn.close()
-        raise HTTPException(status_code=400, detail="Username already exists")
-    cur.execute(
-        "INSERT INTO users(username, password) VALUES (?, ?)",
-        (req.username, req.password),
-    )
-    conn.commit()
+    exists = cur.fetchone()
     conn.close()
+    if exists:
+        raise HTTPException(status_code=400, detail="Username already exists")
+    hashed = await run_hasher(password_hasher.hash(req.password))
+    conn = get_conn()
+    try:
+        conn.execute(
+            "INSERT INTO users(username, password) VALUES (?, ?)",
+            (req.username, hashed),
+        )
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # another signup for the same name finished while we were hashing
+        raise HTTPException(status_code=400, detail="Username already exists")
+    finally:
+        conn.close()
     return GenericResponse(success=True, detail="Account created.")
 
 
@@ -196,11 +641,24 @@ async def login(req: LoginRequest, response: Response):
     cur = conn.execute("SELECT password FROM users WHERE username = ?", (req.username,))
     row = cur.fetchone()
     conn.close()
-    if not row or row["password"] != req.password:
+    # unknown users are checked against a dummy hash so they take as long as wrong passwords
+    stored = row["password"] if row else passwords.DUMMY_HASH
+    ok, needs_rehash = await run_hasher(password_hasher.verify(req.password, stored))
+    if not row or not ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials"
         )
-    sid = create_session(req.username)
+    if needs_rehash:
+        # upgrade plain-text (or outdated) rows; skipped if the row changed meanwhile
+        hashed = await run_hasher(password_hasher.hash(req.password))
+        conn = get_conn()
+        conn.execute(
+            "UPDATE users SET password = ? WHERE username = ? AND password = ?",
+            (hashed, req.username, row["password"]),
+        )
+        conn.commit()
+        conn.close()
+    sid = await diagnostics.to_thread(create_session, req.username)
     response.set_cookie(key="session_id", value=sid, httponly=True, path="/")
     return {"success": True, "detail": "Logged in."}
 
@@ -212,10 +670,7 @@ async def logout(
     """Logout current user: remove session from DB and clear cookie."""
     sid = request.cookies.get("session_id")
     if sid:
-        conn = get_conn()
-        conn.execute("DELETE FROM sessions WHERE session_id = ?", (sid,))
-        conn.commit()
-        conn.close()
+        await diagnostics.to_thread(delete_session, sid)
     # clear cookie on client
     response.delete_cookie("session_id", path="/")
     return {"success": True, "detail": "Logged out."}
@@ -254,6 +709,7 @@ async def send_friend_request(
     )
     conn.commit()
     conn.close()
+    publish([target], {"type": "friend-request", "id": rid, "from": username})
     return GenericResponse(success=True, detail="Request created", id=rid)
 
 
@@ -289,6 +745,10 @@ async def accept_friend_request(
     )
     conn.commit()
     conn.close()
+    if friend_feeds.has_feed(username) or friend_feeds.has_feed(from_user):
+        await ensure_trails([username, from_user])
+    friend_feeds.add_friendship(username, from_user)
+    publish([from_user], {"type": "friend-accepted", "id": request_id, "friend": username})
     return GenericResponse(success=True, detail="Friend added")
 
 
@@ -316,6 +776,7 @@ async def reject_friend_request(
     cur.execute("DELETE FROM friend_requests WHERE id = ?", (request_id,))
     conn.commit()
     conn.close()
+    publish([fr["from_user"]], {"type": "friend-rejected", "id": request_id, "friend": username})
     return GenericResponse(success=True, detail="Request rejected")
 
 
@@ -343,6 +804,7 @@ async def cancel_friend_request(
     cur.execute("DELETE FROM friend_requests WHERE id = ?", (request_id,))
     conn.commit()
     conn.close()
+    publish([fr["to_user"]], {"type": "friend-canceled", "id": request_id, "from": username})
     return GenericResponse(success=True, detail="Request canceled")
 
 
@@ -428,6 +890,8 @@ async def delete_friend(
     )
     conn.commit()
     conn.close()
+    friend_feeds.remove_friendship(username, friend_username)
+    publish([friend_username], {"type": "friend-removed", "friend": username})
 
     return GenericResponse(success=True, message="Friend removed")
 
@@ -435,50 +899,40 @@ async def delete_friend(
 @app.post("/location")
 async def location(loc: Location, username: str = Depends(get_current_username)):
     """Store the caller's location in `locations`, prune older entries (15 minutes),
-    and return all recent location entries for the caller's friends (looked up from `friends`).
+    and return all recent location entries for the caller's friends (looked up from `friends`,
+    or served from the materialized friend feed when FRIEND_FEED is "write").
 
     Request shape: { latitude: float, longitude: float }
-    Response: list of { username, latitude, longitude, ts }
+    Response: list of { username, location, ts, station, line } where station/line are
+    the nearest GTFS stop and line ({ name, distance }) or null.
     """
-    ts = datetime.now(UTC).isoformat()
-    conn = get_conn()
-    # insert own location row
-    conn.execute(
-        "INSERT INTO locations(username, latitude, longitude, ts) VALUES (?, ?, ?, ?)",
-        (username, loc.latitude, loc.longitude, ts),
-    )
-    # cleanup older than 15 minutes
-    cutoff = (datetime.utcnow() - timedelta(minutes=15)).isoformat()
-    conn.execute("DELETE FROM locations WHERE ts < ?", (cutoff,))
+    await record_location(username, loc.latitude, loc.longitude)
+    return await friend_locations(username, location_cutoff())
 
-    # determine friends from the friends table for the current user
-    cur_f = conn.execute(
-        "SELECT friend FROM friends WHERE user = ? ORDER BY friend", (username,)
-    )
-    friends = [r["friend"] for r in cur_f.fetchall()]
-    if not friends:
-        conn.commit()
-        conn.close()
-        return []
 
-    # query locations for the friends
-    placeholders = ",".join("?" for _ in friends)
-    cur = conn.execute(
-        f"SELECT username, latitude, longitude, ts FROM locations WHERE username IN ({placeholders}) ORDER BY ts",
-        tuple(friends),
-    )
-    rows = [
-        {
-            "username": r["username"],
-            "location": {"latitude": r["latitude"], "longitude": r["longitude"]},
-            "ts": r["ts"],
-        }
-        for r in cur.fetchall()
-    ]
-    conn.commit()
-    conn.close()
+@app.get("/admin/profiles", dependencies=[Depends(require_profile_token)])
+async def list_profiles():
+    """List stored request profiles, newest first (requires X-Profile-Token)."""
+    return list(reversed(profiling.recent))
+
+
+@app.get("/admin/profiles/{profile_id}", dependencies=[Depends(require_profile_token)])
+async def get_profile(profile_id: str, text: bool = False):
+    """Download a stored profile as a pstats file, or as a text summary with ?text=true."""
+    path = profiling.profile_path(profile_id)
+    if not re.fullmatch(r"[0-9a-f]{32}", profile_id) or not path.exists():
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if not text:
+        return FileResponse(path, filename=f"{profile_id}.prof")
+    out = io.StringIO()
+    pstats.Stats(str(path), stream=out).sort_stats("cumulative").print_stats(50)
+    return PlainTextResponse(out.getvalue())
 
-    return rows
+
+@app.get("/admin/metrics", dependencies=[Depends(require_metrics_token)])
+async def metrics():
+    """Password hasher pool usage: queue depth, in-flight hashes and rejections."""
+    return {"passwordHasher": password_hasher.stats()}
 
 
 @app.get("/events")
@@ -501,14 +955,113 @@ async def events(request: Request, username: str = Depends(get_current_username)
                     continue
                 yield f"data: {data}\n\n"
         finally:
-            try:
-                sse_queues.get(username, set()).discard(q)
-            except Exception:
-                pass
+            unsubscribe(username, q)
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
 
+@app.websocket("/ws")
+async def ws(websocket: WebSocket):
+    """Bidirectional channel: location uploads up, friend/request events down.
+
+    Authenticated once from the session_id cookie; browser handshakes from an
+    Origin outside ALLOWED_ORIGINS are rejected. Frames are JSON text:
+    - client -> server: `[latitude, longitude]` to report a location (same effect
+      as POST /location), `{"type": "pong"}` to answer a ping.
+    - server -> client: `{"type": "snapshot", "locations": [...]}` once after
+      connecting (same entries as POST /location returns), then the same events
+      as /events (`location`, `friend-request`, ...), `{"type": "ping"}` every
+      WS_PING_INTERVAL seconds and `{"type": "error", ...}` for malformed frames.
+      A client that sends no frame between two pings is disconnected.
+    """
+    origin = websocket.headers.get("origin")
+    if origin is not None and origin not in ALLOWED_ORIGINS:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    username = await diagnostics.to_thread(get_username_from_cookie, websocket)
+    if not username:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    q: asyncio.Queue = asyncio.Queue(maxsize=32)
+    sse_queues.setdefault(username, set()).add(q)
+    last_seen = time.monotonic()
+
+    async def downstream():
+        await websocket.send_json(
+            {"type": "snapshot", "locations": await friend_locations(username, location_cutoff())}
+        )
+        # pings go out on a fixed schedule, independent of event traffic
+        last_ping = None
+        next_ping = time.monotonic() + WS_PING_INTERVAL
+        while True:
+            timeout = next_ping - time.monotonic()
+            if timeout <= 0:
+                # any frame received since the previous ping counts as its answer
+                if last_ping is not None and last_seen < last_ping:
+                    await websocket.close(code=status.WS_1001_GOING_AWAY)
+                    return
+                last_ping = time.monotonic()
+                next_ping = last_ping + WS_PING_INTERVAL
+                await websocket.send_text('{"type": "ping"}')
+                continue
+            try:
+                data = await asyncio.wait_for(q.get(), timeout=timeout)
+            except asyncio.TimeoutError:
+                continue
+            await websocket.send_text(data)
+
+    async def upstream():
+        nonlocal last_seen
+        last_stored = 0.0
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+            last_seen = time.monotonic()
+            frame = None
+            # binary frames carry "bytes" instead of "text" and are invalid
+            if message.get("text") is not None:
+                try:
+                    frame = json.loads(message["text"])
+                except ValueError:
+                    pass
+            if isinstance(frame, dict) and frame.get("type") == "pong":
+                continue
+            coords = None
+            if (
+                isinstance(frame, list)
+                and len(frame) == 2
+                and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in frame)
+            ):
+                try:
+                    coords = (float(frame[0]), float(frame[1]))
+                except OverflowError:
+                    # integers too large for a float
+                    pass
+            if coords is None or not all(math.isfinite(v) for v in coords):
+                await websocket.send_json({"type": "error", "detail": "Invalid frame"})
+                continue
+            if last_seen - last_stored < WS_MIN_LOCATION_INTERVAL:
+                continue
+            last_stored = last_seen
+            await record_location(username, *coords)
+
+    tasks = [asyncio.create_task(downstream()), asyncio.create_task(upstream())]
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for t in pending:
+            t.cancel()
+        for t in done:
+            exc = t.exception()
+            if exc is not None and not isinstance(exc, WebSocketDisconnect):
+                raise exc
+    finally:
+        for t in tasks:
+            t.cancel()
+        unsubscribe(username, q)
+
+
 if __name__ == "__main__":
     import uvicorn
     import argparse
@@ -524,13 +1077,83 @@ if __name__ == "__main__":
         default=None,
         help="Path to sqlite data file to use (overrides default)",
     )
+    parser.add_argument(
+        "--gtfs",
+        default=None,
+        help="Directory of a GTFS feed (stops.txt, optional shapes.txt) for nearest station/line lookup",
+    )
+    parser.add_argument(
+        "--gtfs-cache",
+        default=None,
+        help="File for the binary GTFS index cache (default: next to the data file)",
+    )
+    parser.add_argument(
+        "--profile-token",
+        default=None,
+        help="Enable per-request profiling for requests sending this value in X-Profile-Token",
+    )
+    parser.add_argument(
+        "--slow-query-ms",
+        default=None,
+        type=float,
+        help="Log SQLite statements slower than this many milliseconds, with their query plan",
+    )
+    parser.add_argument(
+        "--friend-feed",
+        default="read",
+        choices=["read", "write"],
+        help="How /location collects friends' positions: query per call (read) or materialized feeds (write)",
+    )
+    parser.add_argument(
+        "--shards",
+        default=1,
+        type=int,
+        help="Split locations and sessions across this many sqlite files next to the data file",
+    )
+    parser.add_argument(
+        "--hash-workers",
+        default=2,
+        type=int,
+        help="Worker processes for password hashing",
+    )
+    parser.add_argument(
+        "--hash-queue",
+        default=64,
+        type=int,
+        help="Logins/signups allowed to wait for a hashing worker before answering 503",
+    )
+    parser.add_argument(
+        "--metrics-token",
+        default=None,
+        help="Serve /admin/metrics to requests sending this value in X-Metrics-Token",
+    )
     args = parser.parse_args()
 
     # If user provided --data, override DB_PATH before initializing DB
     if args.data:
         DB_PATH = Path(args.data).expanduser().resolve()
+    SHARDS = max(1, args.shards)
 
     # Ensure DB is initialized for the chosen path
     init_db()
 
+    profiling.token = args.profile_token
+    if profiling.token:
+        profiling.load_stored()
+    FRIEND_FEED = args.friend_feed
+    password_hasher.workers = max(1, args.hash_workers)
+    password_hasher.max_waiting = max(0, args.hash_queue)
+    METRICS_TOKEN = args.metrics_token
+    if args.slow_query_ms is not None:
+        logging.basicConfig(level=logging.INFO)
+        SLOW_QUERY_MS = args.slow_query_ms
+
+    if args.gtfs:
+        GTFS_PATH = Path(args.gtfs).expanduser().resolve()
+        if args.gtfs_cache:
+            cache_path = Path(args.gtfs_cache).expanduser().resolve()
+        else:
+            cache_path = DB_PATH.with_name(f"{DB_PATH.stem}.gtfs-index.bin")
+        station_index = stations.load_index(GTFS_PATH, cache_path)
+
     uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,125 @@
+"""Password hashing (scrypt) run on a bounded process pool.
+
+scrypt is deliberately slow (tens of milliseconds per hash), so running it in
+an `async def` handler would stall the event loop and every open SSE /
+WebSocket stream with it. PasswordHasher runs it in worker processes, allows
+at most `workers` hashes in flight and sheds load with PasswordHasherBusy once
+`max_waiting` callers are queued, so a login storm cannot starve other traffic.
+
+Stored format: `scrypt$<n>$<r>$<p>$<salt hex>$<hash hex>`. Rows without the
+prefix are legacy plain-text passwords; verify() reports them as needing a
+rehash so callers can upgrade them after a successful login.
+"""
+from __future__ import annotations
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+SCHEME = "scrypt"
+SCRYPT_N = 2**14
+SCRYPT_R = 8
+SCRYPT_P = 1
+
+# verified against when a username does not exist, so unknown users take as
+# long to reject as wrong passwords; no password matches the all-zero digest
+DUMMY_HASH = f"{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${'00' * 16}${'00' * 32}"
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hashes are already waiting for a worker."""
+
+
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+    # runs in a worker process
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=32)
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = 2, max_waiting: int = 64):
+        self.workers = workers
+        self.max_waiting = max_waiting
+        self.running = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        # created on first use so the configured sizes apply and no worker
+        # processes are started before the server runs
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def _run(self, password: str, salt: bytes, n: int, r: int, p: int) -> bytes:
+        if self._pool is None:
+            # forkserver: forking the threaded server process itself is unsafe
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver")
+            )
+            self._slots = asyncio.Semaphore(self.workers)
+        if self._slots.locked():
+            # only callers that actually have to queue count against max_waiting
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                await self._slots.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.running += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, _scrypt, password, salt, n, r, p)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._slots.release()
+
+    async def hash(self, password: str) -> str:
+        salt = os.urandom(16)
+        digest = await self._run(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"{SCHEME}${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${digest.hex()}"
+
+    async def verify(self, password: str, stored: str) -> tuple[bool, bool]:
+        """Return (matches, needs_rehash) for password against a stored value."""
+        parts = stored.split("$")
+        if len(parts) != 6 or parts[0] != SCHEME:
+            # legacy plain-text row; still run scrypt so the response takes as
+            # long as for a hashed row or an unknown user
+            await self._run_dummy(password)
+            return hmac.compare_digest(password.encode(), stored.encode()), True
+        try:
+            n, r, p = int(parts[1]), int(parts[2]), int(parts[3])
+            salt, expected = bytes.fromhex(parts[4]), bytes.fromhex(parts[5])
+            digest = await self._run(password, salt, n, r, p)
+        except ValueError:
+            # malformed row, or parameters scrypt rejects: never matches
+            await self._run_dummy(password)
+            return False, True
+        return hmac.compare_digest(digest, expected), (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    async def _run_dummy(self, password: str) -> None:
+        await self._run(password, b"\0" * 16, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "maxWaiting": self.max_waiting,
+            "running": self.running,
+            "waiting": self.waiting,
+            "peakWaiting": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+            self._slots = None
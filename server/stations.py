@@ -0,0 +1,347 @@
+"""Nearest station / line lookup backed by a local GTFS feed.
+
+The feed directory must contain `stops.txt`; `shapes.txt` is optional and, when
+present, is used to answer "which line is this point on". `trips.txt` and
+`routes.txt` are used (if present) to turn shape ids into route names.
+
+Points are bucketed into a uniform lat/lon grid and kept in flat arrays. A
+lookup scans a window of about one cell around the query (one binary search per
+grid row plus a distance check for the points in the covered cells) and widens
+it only while a closer point could lie outside, up to MAX_DISTANCE_M. Shapes are
+densified to a vertex every SHAPE_STEP_M metres (so points between distant
+vertices still match their line) and vertices of the same line closer than that
+are merged; line vertices get a finer grid than stops, so a query near a hub
+checks only the vertices right around it. The arrays are written once to a
+binary cache file and memory-mapped on later starts, so restarts do not
+re-parse the CSV files; if the cache cannot be written the index is kept in
+memory only.
+"""
+from __future__ import annotations
+import csv
+import hashlib
+import logging
+import math
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+from typing import Optional
+
+log = logging.getLogger("trainfriends.stations")
+
+# Grid cell size in degrees for stops (~330 m north/south, ~220 m east/west in
+# Munich) and for line vertices (~55 m / ~37 m, about two densified vertices per
+# line and cell).
+CELL_DEG = 0.003
+LINE_CELL_DEG = 0.0005
+MAX_DISTANCE_M = 300.0
+# spacing of the densified shape vertices; a point on a line is at most half
+# of this away from the nearest vertex
+SHAPE_STEP_M = 30.0
+
+CACHE_NAME = ".trainfriends-index.bin"
+CACHE_MAGIC = b"TFGRID03"
+# magic, source fingerprint, stop points, stop cells, line points, line cells, names bytes
+_HEADER = struct.Struct("<8s20sQQQQQ")
+
+_EARTH_RADIUS_M = 6371000.0
+_M_PER_DEG = math.pi * _EARTH_RADIUS_M / 180
+
+
+def _distance_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    # equirectangular approximation: accurate to well under a metre at these distances
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return _EARTH_RADIUS_M * math.hypot(x, y)
+
+
+class _Grid:
+    """Points sorted by grid cell.
+
+    `keys[i]` is the i-th occupied cell and its points live in
+    `lat/lon/label[starts[i]:starts[i + 1]]`. `label` indexes into the shared
+    name table of the owning StationIndex.
+    """
+
+    def __init__(self, cell_deg: float, keys, starts, lat, lon, label):
+        self.cell_deg = cell_deg
+        self.row_offset = math.ceil(90 / cell_deg)
+        self.col_offset = math.ceil(180 / cell_deg)
+        self.cols = 2 * self.col_offset + 1
+        self.keys = keys
+        self.starts = starts
+        self.lat = lat
+        self.lon = lon
+        self.label = label
+
+    @classmethod
+    def build(cls, cell_deg: float, points: list[tuple[float, float, int]]) -> "_Grid":
+        grid = cls(cell_deg, None, None, None, None, None)
+        keyed = []
+        for lat, lon, label in points:
+            row = math.floor(lat / cell_deg) + grid.row_offset
+            col = math.floor(lon / cell_deg) + grid.col_offset
+            keyed.append((row * grid.cols + col, lat, lon, label))
+        keyed.sort()
+        keys, starts = array("q"), array("q")
+        lats, lons, labels = array("d"), array("d"), array("q")
+        for i, (key, lat, lon, label) in enumerate(keyed):
+            if not keys or keys[-1] != key:
+                keys.append(key)
+                starts.append(i)
+            lats.append(lat)
+            lons.append(lon)
+            labels.append(label)
+        starts.append(len(keyed))
+        grid.keys, grid.starts, grid.lat, grid.lon, grid.label = keys, starts, lats, lons, labels
+        return grid
+
+    def nearest(self, lat: float, lon: float, max_distance_m: float) -> Optional[tuple[int, float]]:
+        """Return (label, distance in metres) of the closest point, or None."""
+        coslat = math.cos(math.radians(lat))
+        max_deg = max_distance_m / _M_PER_DEG
+        # compare squared distances in degrees of latitude; convert the winner only
+        best_i, best = -1, max_deg * max_deg
+        # search outward: a window of about one cell first, widened only while a
+        # point outside it could still be closer than the best one found
+        radius = min(self.cell_deg, max_deg)
+        while True:
+            best_i, best = self._scan(lat, lon, coslat, radius, best_i, best)
+            if radius >= max_deg or best <= radius * radius:
+                break
+            if best_i >= 0:
+                # nothing outside sqrt(best) can win: one last, final scan
+                best_i, best = self._scan(lat, lon, coslat, math.sqrt(best), best_i, best)
+                break
+            radius = min(max_deg, 4 * radius)
+        if best_i < 0:
+            return None
+        return self.label[best_i], _distance_m(lat, lon, self.lat[best_i], self.lon[best_i])
+
+    def _scan(self, lat: float, lon: float, coslat: float, radius: float, best_i: int, best: float):
+        """Check the points of all cells overlapping lat/lon +- radius (degrees of latitude)."""
+        cell, cols = self.cell_deg, self.cols
+        keys, starts, lats, lons = self.keys, self.starts, self.lat, self.lon
+        lon_radius = radius / max(coslat, 0.01)
+        col_lo = math.floor((lon - lon_radius) / cell) + self.col_offset
+        col_hi = math.floor((lon + lon_radius) / cell) + self.col_offset
+        row_lo = math.floor((lat - radius) / cell) + self.row_offset
+        row_hi = math.floor((lat + radius) / cell) + self.row_offset
+        # keys of the whole window first: empty windows cost two searches
+        lo = bisect_left(keys, row_lo * cols + col_lo)
+        end = bisect_right(keys, row_hi * cols + col_hi, lo)
+        for r in range(row_lo, row_hi + 1):
+            if lo == end:
+                break
+            base = r * cols
+            # the cells of a row are adjacent keys, so one range covers them
+            lo = bisect_left(keys, base + col_lo, lo, end)
+            hi = bisect_right(keys, base + col_hi, lo, end)
+            if lo == hi:
+                continue
+            for i in range(starts[lo], starts[hi]):
+                dy = lats[i] - lat
+                dx = (lons[i] - lon) * coslat
+                d = dx * dx + dy * dy
+                if d <= best:
+                    best_i, best = i, d
+            lo = hi
+        return best_i, best
+
+    def arrays(self):
+        return (self.keys, self.starts, self.lat, self.lon, self.label)
+
+
+class StationIndex:
+    """Spatial index of GTFS stops and (optionally) line shapes."""
+
+    def __init__(self, stops: _Grid, lines: _Grid, names: list[str], _mm: Optional[mmap.mmap] = None):
+        self.stops = stops
+        self.lines = lines
+        self.names = names
+        # keep the mapping alive for as long as the memoryviews into it are used
+        self._mm = _mm
+
+    def nearest_station(self, lat: float, lon: float, max_distance_m: float = MAX_DISTANCE_M) -> Optional[dict]:
+        hit = self.stops.nearest(lat, lon, max_distance_m)
+        if hit is None:
+            return None
+        return {"name": self.names[hit[0]], "distance": round(hit[1], 1)}
+
+    def nearest_line(self, lat: float, lon: float, max_distance_m: float = MAX_DISTANCE_M) -> Optional[dict]:
+        hit = self.lines.nearest(lat, lon, max_distance_m)
+        if hit is None:
+            return None
+        return {"name": self.names[hit[0]], "distance": round(hit[1], 1)}
+
+
+def _read_csv(path: Path):
+    # GTFS files are frequently written with a BOM
+    with path.open(newline="", encoding="utf-8-sig") as fh:
+        yield from csv.DictReader(fh)
+
+
+def _fingerprint(feed_dir: Path) -> bytes:
+    h = hashlib.sha1()
+    h.update(struct.pack("<ddd", CELL_DEG, LINE_CELL_DEG, SHAPE_STEP_M))
+    for name in ("stops.txt", "shapes.txt", "trips.txt", "routes.txt"):
+        p = feed_dir / name
+        if p.exists():
+            st = p.stat()
+            h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.digest()
+
+
+def _shape_line_names(feed_dir: Path) -> dict[str, str]:
+    trips, routes = feed_dir / "trips.txt", feed_dir / "routes.txt"
+    if not trips.exists() or not routes.exists():
+        return {}
+    route_names = {
+        r["route_id"]: r.get("route_short_name") or r.get("route_long_name") or r["route_id"]
+        for r in _read_csv(routes)
+    }
+    out: dict[str, str] = {}
+    for t in _read_csv(trips):
+        shape_id = t.get("shape_id")
+        if shape_id and shape_id not in out and t.get("route_id") in route_names:
+            out[shape_id] = route_names[t["route_id"]]
+    return out
+
+
+def _densify(pts: list[tuple[float, float]]):
+    """Yield the shape vertices plus points every SHAPE_STEP_M along each segment."""
+    for i, (lat, lon) in enumerate(pts):
+        yield lat, lon
+        if i + 1 == len(pts):
+            break
+        nlat, nlon = pts[i + 1]
+        steps = int(_distance_m(lat, lon, nlat, nlon) // SHAPE_STEP_M)
+        for k in range(1, steps + 1):
+            f = k / (steps + 1)
+            yield lat + (nlat - lat) * f, lon + (nlon - lon) * f
+
+
+def build_index(feed_dir: Path) -> StationIndex:
+    """Parse the GTFS CSV files in feed_dir into an in-memory StationIndex."""
+    names: list[str] = []
+    name_ids: dict[str, int] = {}
+
+    def intern(name: str) -> int:
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        return name_ids[name]
+
+    stop_points = []
+    for r in _read_csv(feed_dir / "stops.txt"):
+        try:
+            lat, lon = float(r["stop_lat"]), float(r["stop_lon"])
+        except (KeyError, ValueError):
+            continue
+        stop_points.append((lat, lon, intern(r.get("stop_name") or r["stop_id"])))
+
+    line_points = []
+    shapes = feed_dir / "shapes.txt"
+    if shapes.exists():
+        line_names = _shape_line_names(feed_dir)
+        vertices: dict[str, list[tuple[float, float, float]]] = {}
+        for r in _read_csv(shapes):
+            try:
+                lat, lon = float(r["shape_pt_lat"]), float(r["shape_pt_lon"])
+                seq = float(r["shape_pt_sequence"])
+            except (KeyError, ValueError):
+                continue
+            vertices.setdefault(r["shape_id"], []).append((seq, lat, lon))
+        # shapes of one line mostly run along the same track: snapping the
+        # densified vertices to a SHAPE_STEP_M grid per line removes the overlap
+        snap = SHAPE_STEP_M / _M_PER_DEG
+        seen: set[tuple[int, int, int]] = set()
+        for shape_id, pts in vertices.items():
+            label = intern(line_names.get(shape_id, shape_id))
+            pts.sort()
+            for lat, lon in _densify([(lat, lon) for _, lat, lon in pts]):
+                key = (round(lat / snap), round(lon / snap), label)
+                if key not in seen:
+                    seen.add(key)
+                    line_points.append((lat, lon, label))
+
+    return StationIndex(_Grid.build(CELL_DEG, stop_points), _Grid.build(LINE_CELL_DEG, line_points), names)
+
+
+def _write_cache(index: StationIndex, path: Path, fingerprint: bytes) -> None:
+    names_blob = "\n".join(index.names).encode("utf-8")
+    header = _HEADER.pack(
+        CACHE_MAGIC,
+        fingerprint,
+        len(index.stops.lat),
+        len(index.stops.keys),
+        len(index.lines.lat),
+        len(index.lines.keys),
+        len(names_blob),
+    )
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("wb") as fh:
+        fh.write(header)
+        # header is 68 bytes; pad so every 8-byte array starts aligned
+        fh.write(b"\0" * (-len(header) % 8))
+        for arr in index.stops.arrays() + index.lines.arrays():
+            arr.tofile(fh)
+        fh.write(names_blob)
+    tmp.replace(path)
+
+
+def _load_cache(path: Path, fingerprint: bytes) -> Optional[StationIndex]:
+    with path.open("rb") as fh:
+        mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(mm) < _HEADER.size:
+        mm.close()
+        return None
+    magic, fp, n_stops, n_stop_cells, n_lines, n_line_cells, names_len = _HEADER.unpack_from(mm)
+    if magic != CACHE_MAGIC or fp != fingerprint:
+        mm.close()
+        return None
+
+    view = memoryview(mm)
+    pos = _HEADER.size + (-_HEADER.size % 8)
+
+    def take(count: int, fmt: str):
+        nonlocal pos
+        chunk = view[pos : pos + count * 8].cast(fmt)
+        pos += count * 8
+        return chunk
+
+    grids = []
+    for cell_deg, n_points, n_cells in ((CELL_DEG, n_stops, n_stop_cells), (LINE_CELL_DEG, n_lines, n_line_cells)):
+        keys = take(n_cells, "q")
+        starts = take(n_cells + 1, "q")
+        grids.append(_Grid(cell_deg, keys, starts, take(n_points, "d"), take(n_points, "d"), take(n_points, "q")))
+    blob = bytes(view[pos : pos + names_len])
+    names = blob.decode("utf-8").split("\n") if blob else []
+    return StationIndex(grids[0], grids[1], names, _mm=mm)
+
+
+def load_index(feed_dir: Path, cache_path: Optional[Path] = None) -> StationIndex:
+    """Return a StationIndex for the GTFS feed in feed_dir.
+
+    Uses the memory-mapped cache file (default: CACHE_NAME inside feed_dir)
+    when it matches the current feed files, otherwise rebuilds the index from
+    CSV and rewrites the cache. If the cache cannot be written, e.g. because
+    its directory is read-only, the freshly built index is used from memory.
+    """
+    feed_dir = Path(feed_dir)
+    if not (feed_dir / "stops.txt").exists():
+        raise FileNotFoundError(f"GTFS stops.txt not found in {feed_dir}")
+    cache_path = Path(cache_path) if cache_path else feed_dir / CACHE_NAME
+    fingerprint = _fingerprint(feed_dir)
+    if cache_path.exists():
+        index = _load_cache(cache_path, fingerprint)
+        if index is not None:
+            return index
+    index = build_index(feed_dir)
+    try:
+        _write_cache(index, cache_path, fingerprint)
+    except OSError as e:
+        log.warning("cannot write GTFS index cache %s (%s); keeping the index in memory", cache_path, e)
+        return index
+    return _load_cache(cache_path, fingerprint)